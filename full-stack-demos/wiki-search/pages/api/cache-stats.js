@@ -0,0 +1,9 @@
+import { embeddingCache, resultCache } from "@/utils/cache";
+
+// Handle the /cache-stats endpoint
+export default function handler(req, res) {
+  res.status(200).json({
+    embeddings: embeddingCache.stats(),
+    results: resultCache.stats(),
+  });
+}
@@ -1,69 +1,126 @@
 import { DBQuery } from "@/utils/db";
+import {
+  embeddingCache,
+  normalizeQueryText,
+  resultCache,
+  resultCacheKey,
+} from "@/utils/cache";
+
+// Overridable so tests can point the API at a local stub of the embed endpoint
+const COHERE_EMBED_URL =
+  process.env.COHERE_EMBED_URL || "https://api.cohere.ai/v1/embed";
+const LIMIT = 10;
+// With TWO_STAGE_OVERSAMPLE set, candidates come from the binary quantized codes built by
+// pyutils/loaddata.py --create-bq-index and are re-ranked on the full vectors
+const TWO_STAGE_OVERSAMPLE = parseInt(process.env.TWO_STAGE_OVERSAMPLE || "0", 10);
+// The table pyutils/loaddata.py creates and indexes with dist_l2sq_ops
+const TABLE_NAME = "passages";
 
 function normalizeVector(vector) {
   let magnitude = Math.sqrt(vector.reduce((sum, val) => sum + val * val, 0));
   return vector.map((val) => val / magnitude);
 }
 
+// One bit per dimension, set when the value is above the center. Bit i is bit
+// i % 32 of word i / 32, the same layout as binary_quantize in loaddata.py
+function binaryQuantize(vector, center) {
+  const words = new Int32Array(Math.ceil(vector.length / 32));
+  vector.forEach((val, i) => {
+    if (val > center[i]) {
+      words[i >> 5] |= 1 << (i & 31);
+    }
+  });
+  return Array.from(words);
+}
+
+let bqCenter;
+
+async function getBqCenter() {
+  if (bqCenter === undefined) {
+    const { rows } = await DBQuery(`SELECT center FROM ${TABLE_NAME}_bq_center;`);
+    bqCenter = rows[0].center;
+  }
+  return bqCenter;
+}
+
+async function searchPassages(embedding_vector) {
+  // Stored and query vectors are unit length, so l2sq distance orders results like cosine
+  // distance without re-normalizing every row, and cos_dist is simply half of it
+  if (!TWO_STAGE_OVERSAMPLE) {
+    const search_query = `SELECT title, text_content, url, dist / 2 AS cos_dist FROM (SELECT title, text_content, url, emb <-> $1::real[] AS dist FROM ${TABLE_NAME} ORDER BY dist LIMIT $2) nearest;`;
+    return DBQuery(search_query, [embedding_vector, LIMIT]);
+  }
+  // The hamming index returns LIMIT * oversample candidates, exact l2sq_dist on their full vectors picks the results
+  const code = binaryQuantize(embedding_vector, await getBqCenter());
+  const search_query = `WITH candidates AS MATERIALIZED (SELECT id FROM ${TABLE_NAME}_bq ORDER BY code <+> $1::integer[] LIMIT $2) SELECT title, text_content, url, l2sq_dist(emb, $3::real[]) / 2 AS cos_dist FROM candidates JOIN ${TABLE_NAME} USING (id) ORDER BY cos_dist LIMIT $4;`;
+  return DBQuery(search_query, [code, LIMIT * TWO_STAGE_OVERSAMPLE, embedding_vector, LIMIT]);
+}
+
+// Get the embedding from cohere
+async function fetchEmbedding(query) {
+  const response = await fetch(COHERE_EMBED_URL, {
+    method: "POST",
+    headers: {
+      accept: "application/json",
+      authorization: `Bearer ${process.env.COHERE_API_KEY}`,
+      "content-type": "application/json",
+    },
+    body: JSON.stringify({
+      texts: [query],
+      truncate: "END",
+      model: "embed-multilingual-v2.0",
+    }),
+  });
+
+  if (!response.ok) {
+    throw new Error(`Error: ${response.status}`);
+  }
+
+  const data = await response.json();
+
+  // Check if the 'embeddings' field is present in the response
+  if (data && data.embeddings) {
+    return normalizeVector(data.embeddings[0]);
+  } else {
+    throw new Error("Embeddings field not found in the response");
+  }
+}
+
 // Handle the /search endpoint
 export default async function handler(req, res) {
   if (req.method === "POST") {
     const { query } = req.body;
 
-    // Get the embedding from cohere
-    try {
-      const response = await fetch("https://api.cohere.ai/v1/embed", {
-        method: "POST",
-        headers: {
-          accept: "application/json",
-          authorization: `Bearer ${process.env.COHERE_API_KEY}`,
-          "content-type": "application/json",
-        },
-        body: JSON.stringify({
-          texts: [query],
-          truncate: "END",
-          model: "embed-multilingual-v2.0",
-        }),
-      });
-
-      if (!response.ok) {
-        throw new Error(`Error: ${response.status}`);
-      }
+    const embeddingKey = normalizeQueryText(query);
+    var embedding_vector = embeddingCache.get(embeddingKey);
+    if (embedding_vector === undefined) {
+      try {
+        embedding_vector = await fetchEmbedding(query);
+      } catch (error) {
+        console.error("Cohere API call failed:", error);
+        res.status(500).json({
+          error: "Failed to fetch data from Cohere, or embeddings missing",
+        });
 
-      const data = await response.json();
-
-      // Check if the 'embeddings' field is present in the response
-      if (data && data.embeddings) {
-        //res.status(200).json({ embeddings: data.embeddings });
-        var embedding_vector = data.embeddings[0];
-        embedding_vector = normalizeVector(embedding_vector);
-      } else {
-        throw new Error("Embeddings field not found in the response");
+        return;
       }
-    } catch (error) {
-      console.error("Cohere API call failed:", error);
-      res.status(500).json({
-        error: "Failed to fetch data from Cohere, or embeddings missing",
-      });
-
-      return;
+      embeddingCache.set(embeddingKey, embedding_vector);
     }
 
     const startTime = new Date();
 
     // Perform vector search with Lantern
-    const TABLE_NAME = "passages2";
-
-    await DBQuery("SET enable_seqscan = false;");
-
-    const embedding_vector_str = `[${embedding_vector.join(",")}]`;
-
-    try {
-      const search_query = `SELECT title, text_content, url, cos_dist(emb, ARRAY${embedding_vector_str}) FROM ${TABLE_NAME} ORDER BY emb <=> ARRAY${embedding_vector_str} LIMIT 10;`;
-      var { rows } = await DBQuery(search_query);
-    } catch (error) {
-      console.error("Database query error:", error);
-      res.status(500).json({ error: "Internal server error" });
+    const resultKey = resultCacheKey(embedding_vector, LIMIT);
+    var rows = resultCache.get(resultKey);
+    if (rows === undefined) {
+      try {
+        ({ rows } = await searchPassages(embedding_vector));
+      } catch (error) {
+        console.error("Database query error:", error);
+        res.status(500).json({ error: "Internal server error" });
+        return;
+      }
+      resultCache.set(resultKey, rows);
     }
 
     const endTime = new Date();
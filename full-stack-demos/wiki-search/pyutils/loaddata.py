@@ -1,67 +1,374 @@
 from datasets import load_dataset
+import argparse
+import io
+import queue
+import threading
 import time
 import psycopg2
 import numpy as np
+import pyarrow as pa
+from pgpq import ArrowToPostgresBinaryEncoder
 
 from oursecrets import LANTERN_PG_URI
 
-# Postgres setup
-conn = psycopg2.connect(LANTERN_PG_URI)
-print("Connected to Lantern database!")
 TABLE_NAME = "passages"
+CHECKPOINT_TABLE = "loaddata_checkpoint"
 
-# Load dataset incrementally
-entire_dataset = load_dataset("Cohere/wikipedia-22-12-en-embeddings", split="train", streaming=True) 
-# We can skip the first N=500 rows like this:
-#entire_dataset = entire_dataset.skip(500)
+# table column -> dataset field
+COLUMNS = {
+    "id": "id",
+    "title": "title",
+    "text_content": "text",
+    "url": "url",
+    "wiki_id": "wiki_id",
+    "views": "views",
+    "paragraph_id": "paragraph_id",
+    "langs": "langs",
+    "emb": "emb",
+}
 
-def normalize_vector(v):
-    v = np.array(v)
-    magnitude = np.linalg.norm(v)
-    return (v / magnitude).tolist()
+# postgres type (pg_type.typname) -> arrow type that pgpq encodes as that type in binary COPY
+ARROW_TYPES = {
+    "int2": pa.int16(),
+    "int4": pa.int32(),
+    "int8": pa.int64(),
+    "float4": pa.float32(),
+    "float8": pa.float64(),
+    "text": pa.string(),
+    "varchar": pa.string(),
+    "bool": pa.bool_(),
+    "_float4": pa.list_(pa.float32()),
+    "_float8": pa.list_(pa.float64()),
+}
+
+_DONE = object()
+
+# vectors are normalized once at ingestion and sent as binary float32, the most compact float array
+# postgres stores. since every row has unit length, l2sq distance ranks exactly like cosine distance
+# (l2sq = 2 * cos_dist), so the index uses dist_l2sq_ops and search skips re-normalizing every row.
+# float16/int8 compression happens inside the index through lantern's quant_bits
+CREATE_TABLE = f"""
+CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+    id integer PRIMARY KEY,
+    title text,
+    text_content text,
+    url text,
+    wiki_id integer,
+    views real,
+    paragraph_id integer,
+    langs smallint,
+    emb real[]
+)"""
+
+QUANT_BITS = {"float32": None, "float16": 16, "int8": 8}
+
+# binary quantized codes for two-stage search in pages/api/search.js: one sign bit per dimension around
+# a sampled per-dimension center, packed into int4 words and searched with a hamming lantern_hnsw index.
+# the API re-ranks the candidates with l2sq_dist on the full vectors
+BQ_TABLE = f"{TABLE_NAME}_bq"
+BQ_SCHEMA = pa.schema([("id", pa.int32()), ("code", pa.list_(pa.int32()))])
 
-def batch_insert(rows):
-    start = time.time()
 
-    data = [(row['id'], row['title'], row['text'], row['url'], row['wiki_id'], row['views'], row['paragraph_id'], row['langs'], row['emb']) for row in rows]
-    #print(data)
+def create_index(conn, quantization):
+    quant_bits = QUANT_BITS[quantization]
+    with_q = f" WITH (quant_bits = {quant_bits})" if quant_bits else ""
     cur = conn.cursor()
+    start = time.time()
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {TABLE_NAME}_emb_l2sq_idx ON {TABLE_NAME} USING lantern_hnsw (emb dist_l2sq_ops){with_q}")
+    conn.commit()
+    cur.close()
+    print(f"Built the {quantization} HNSW index in {time.time() - start:.1f}s")
+
+
+def binary_quantize(vectors, center):
+    # bit i of a vector is bit i % 32 of word i // 32, the same layout search.js builds for the query
+    bits = np.atleast_2d(np.asarray(vectors, dtype=np.float32)) > center
+    words = -(-bits.shape[1] // 32)
+    bits = np.pad(bits, ((0, 0), (0, words * 32 - bits.shape[1])))
+    return np.ascontiguousarray(np.packbits(bits, axis=1, bitorder="little")).view("<i4")
 
-    query = f"INSERT INTO {TABLE_NAME} (id, title, text_content, url, wiki_id, views, paragraph_id, langs, emb) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"
 
-    cur.executemany(query, data)
+def create_bq_index(conn, batch_size, sample_rows=100_000):
+    start = time.time()
+    cur = conn.cursor()
+    cur.execute(f"SELECT emb FROM {TABLE_NAME} TABLESAMPLE SYSTEM (1) LIMIT %s", (sample_rows,))
+    sample = cur.fetchall()
+    if not sample:
+        cur.execute(f"SELECT emb FROM {TABLE_NAME} LIMIT %s", (sample_rows,))
+        sample = cur.fetchall()
+    center = np.asarray([row[0] for row in sample], dtype=np.float32).mean(axis=0)
+    words = binary_quantize(center, center).shape[1]
+    cur.execute(f"DROP TABLE IF EXISTS {BQ_TABLE}, {BQ_TABLE}_center")
+    cur.execute(f"CREATE TABLE {BQ_TABLE}_center (center real[])")
+    cur.execute(f"INSERT INTO {BQ_TABLE}_center VALUES (%s)", ([float(v) for v in center],))
+    cur.execute(f"CREATE TABLE {BQ_TABLE} (id integer PRIMARY KEY, code integer[])")
+
+    # one transaction: the named cursor keeps scanning while the codes are copied batch by batch
+    scan = conn.cursor(name="bq_scan")
+    scan.execute(f"SELECT id, emb FROM {TABLE_NAME}")
+    rows = 0
+    while batch := scan.fetchmany(batch_size):
+        ids, vectors = zip(*batch)
+        codes = binary_quantize(np.asarray(vectors, dtype=np.float32), center)
+        record_batch = pa.RecordBatch.from_arrays(
+            [
+                pa.array(ids, pa.int32()),
+                pa.FixedSizeListArray.from_arrays(pa.array(codes.ravel()), words).cast(pa.list_(pa.int32())),
+            ],
+            schema=BQ_SCHEMA,
+        )
+        encoder = ArrowToPostgresBinaryEncoder(BQ_SCHEMA)
+        data = encoder.write_header() + encoder.write_batch(record_batch) + encoder.finish()
+        cur.copy_expert(f"COPY {BQ_TABLE} (id, code) FROM STDIN WITH (FORMAT BINARY)", io.BytesIO(data))
+        rows += len(batch)
+        print(f"Quantized {rows} passages ({rows / (time.time() - start):.0f} rows/sec)")
+    scan.close()
+    cur.execute(f"CREATE INDEX {BQ_TABLE}_hamming_idx ON {BQ_TABLE} USING lantern_hnsw (code dist_hamming_ops) WITH (dim={words})")
     conn.commit()
+    cur.execute(f"SELECT pg_relation_size('{BQ_TABLE}_hamming_idx'), pg_relation_size(to_regclass('{TABLE_NAME}_emb_l2sq_idx'))")
+    bq_bytes, full_bytes = cur.fetchone()
+    cur.close()
+    print(f"Built {BQ_TABLE} with {words * 32} bit codes in {time.time() - start:.1f}s, hamming index {bq_bytes / 1024**2:.1f}MB"
+          + (f" vs {full_bytes / 1024**2:.1f}MB for the real[] index" if full_bytes else ""))
+
 
+def table_schema(conn):
+    # binary COPY needs the exact column types, so the arrow schema is derived from the table itself
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT column_name, udt_name FROM information_schema.columns WHERE table_name = %s",
+        (TABLE_NAME,),
+    )
+    types = dict(cur.fetchall())
     cur.close()
+    if types.get("emb") == "_float8":
+        print(f"WARNING: {TABLE_NAME}.emb is double precision[], real[] stores the same vectors in half the space")
+    return pa.schema([(column, ARROW_TYPES[types[column]]) for column in COLUMNS])
+
+
+def normalize_vectors(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class Checkpoint:
+    # batches finish out of order across writers. every writer records the row range of its batch in
+    # the checkpoint table in the same transaction as the COPY, so a batch is either loaded and recorded
+    # or neither, even when the loader is killed in between. offset is the row below which every row is
+    # committed, done holds the finished ranges above it so a resumed run does not load them twice
+    def __init__(self, conn, table, batch_size):
+        self.table = table
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        cur = conn.cursor()
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table} (start_row bigint PRIMARY KEY, end_row bigint NOT NULL, batch_size integer NOT NULL)")
+        cur.execute(f"SELECT start_row, end_row, batch_size FROM {table} ORDER BY start_row")
+        ranges = cur.fetchall()
+        conn.commit()
+        cur.close()
+        # the finished ranges only line up with the new batches when the batch size is the same
+        sizes = {size for _, _, size in ranges}
+        if sizes and sizes != {batch_size}:
+            raise ValueError(
+                f"{table} was written with --batch-size {sorted(sizes)}, resume with the same batch size "
+                f"or drop {table} and {TABLE_NAME} to start over"
+            )
+        self.offset = 0
+        self.done = []
+        for start, end, _ in ranges:
+            self._add(start, end)
+
+    def _add(self, start, end):
+        self.done.append((start, end))
+        self.done.sort()
+        while self.done and self.done[0][0] <= self.offset:
+            self.offset = max(self.offset, self.done.pop(0)[1])
+
+    def is_done(self, start, end):
+        return end <= self.offset or any(s <= start and end <= e for s, e in self.done)
+
+    def record(self, cur, start, end):
+        # part of the writer's transaction, committed together with the batch
+        cur.execute(f"INSERT INTO {self.table} VALUES (%s, %s, %s)", (start, end, self.batch_size))
+
+    def mark_done(self, start, end):
+        # called once the transaction is committed
+        with self.lock:
+            self._add(start, end)
+
+
+def _put(out_queue, item, stop):
+    # blocks while the next stage is busy, but gives up once the load is being stopped
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def fetch_stage(dataset, checkpoint, num_rows, batch_size, out_queue, stop):
+    # stage 1: pull rows from the streaming dataset and group them into columnar batches.
+    # the end marker is queued even when fetching fails, so the later stages never wait forever
+    try:
+        batch = {field: [] for field in COLUMNS.values()}
+        start = checkpoint.offset
+        for i, row in enumerate(dataset, start=checkpoint.offset):
+            if i >= num_rows or stop.is_set():
+                break
+            for field in batch:
+                batch[field].append(row[field])
+            if len(batch["emb"]) == batch_size:
+                if not checkpoint.is_done(start, i + 1) and not _put(out_queue, (start, i + 1, batch), stop):
+                    return
+                batch = {field: [] for field in COLUMNS.values()}
+                start = i + 1
+        if batch["emb"] and not checkpoint.is_done(start, start + len(batch["emb"])):
+            _put(out_queue, (start, start + len(batch["emb"]), batch), stop)
+    finally:
+        out_queue.put(_DONE)
+
+
+def normalize_stage(schema, in_queue, out_queue, writers, stop):
+    # stage 2: normalize a whole batch of vectors at once and build the arrow record batch
+    try:
+        _normalize_batches(schema, in_queue, out_queue, stop)
+    finally:
+        for _ in range(writers):
+            out_queue.put(_DONE)
+
+
+def _normalize_batches(schema, in_queue, out_queue, stop):
+    while not stop.is_set():
+        item = in_queue.get()
+        if item is _DONE:
+            break
+        start, end, batch = item
+        batch["emb"] = normalize_vectors(batch["emb"])
+        arrays = []
+        for column, field in COLUMNS.items():
+            arrow_type = schema.field(column).type
+            if field == "emb":
+                offsets = np.arange(0, batch["emb"].size + 1, batch["emb"].shape[1], dtype=np.int32)
+                values = pa.array(batch["emb"].ravel()).cast(arrow_type.value_type)
+                arrays.append(pa.ListArray.from_arrays(pa.array(offsets), values))
+            else:
+                arrays.append(pa.array(batch[field], type=arrow_type))
+        if not _put(out_queue, (start, end, pa.RecordBatch.from_arrays(arrays, schema=schema)), stop):
+            return
+
+
+def write_stage(schema, in_queue, checkpoint, progress, stop):
+    # stage 3: binary COPY of each record batch, every writer has its own connection
+    conn = psycopg2.connect(LANTERN_PG_URI)
+    cur = conn.cursor()
+    copy_query = f"COPY {TABLE_NAME} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT BINARY)"
+    try:
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            start, end, record_batch = item
+            encoder = ArrowToPostgresBinaryEncoder(schema)
+            data = encoder.write_header() + encoder.write_batch(record_batch) + encoder.finish()
+            cur.copy_expert(copy_query, io.BytesIO(data))
+            checkpoint.record(cur, start, end)
+            conn.commit()
+            checkpoint.mark_done(start, end)
+            progress(end - start)
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load Cohere Wikipedia embeddings into Lantern")
+    parser.add_argument("--num-rows", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=5_000)
+    parser.add_argument("--writers", type=int, default=4, help="parallel COPY connections")
+    parser.add_argument("--queue-size", type=int, default=8, help="batches buffered between stages")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_TABLE, help="table that records the loaded row ranges")
+    parser.add_argument("--create-table", action="store_true", help=f"create {TABLE_NAME} with compact column types")
+    parser.add_argument("--create-index", action="store_true", help="build the HNSW index after loading")
+    parser.add_argument("--quantization", choices=QUANT_BITS, default="float32", help="vector precision inside the index")
+    parser.add_argument("--create-bq-index", action="store_true", help="build the binary quantized codes for two-stage search")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(LANTERN_PG_URI)
+    print("Connected to Lantern database!")
+    if args.create_table:
+        cur = conn.cursor()
+        cur.execute(CREATE_TABLE)
+        conn.commit()
+        cur.close()
+    schema = table_schema(conn)
+    checkpoint = Checkpoint(conn, args.checkpoint, args.batch_size)
+    conn.close()
+
+    # Load dataset incrementally, resuming after the last committed offset
+    entire_dataset = load_dataset("Cohere/wikipedia-22-12-en-embeddings", split="train", streaming=True)
+    if checkpoint.offset:
+        print(f"Resuming at row {checkpoint.offset}")
+        entire_dataset = entire_dataset.skip(checkpoint.offset)
+
+    fetched = queue.Queue(maxsize=args.queue_size)
+    normalized = queue.Queue(maxsize=args.queue_size)
+    stop = threading.Event()
 
-    elapsed = time.time() - start
-    return elapsed
+    loaded = 0
+    start_time = time.time()
+    progress_lock = threading.Lock()
 
+    def progress(rows):
+        nonlocal loaded
+        with progress_lock:
+            loaded += rows
+            elapsed = time.time() - start_time
+            print(f"Loaded {loaded} rows, committed through row {checkpoint.offset} ({loaded / elapsed:.0f} rows/sec)")
 
-# Begin inserting rows
-num_rows = 1_000_000
-batch_size = 1_000
+    errors = []
 
-batch = []
-batch_n = 1
+    def run(target, *target_args):
+        try:
+            target(*target_args)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
 
-batch_start = time.time()
+    threads = [
+        threading.Thread(target=run, args=(fetch_stage, entire_dataset, checkpoint, args.num_rows, args.batch_size, fetched, stop)),
+        threading.Thread(target=run, args=(normalize_stage, schema, fetched, normalized, args.writers, stop)),
+    ] + [
+        threading.Thread(target=run, args=(write_stage, schema, normalized, checkpoint, progress, stop))
+        for _ in range(args.writers)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    # a failed stage sets stop, and the fetch and normalize stages always queue their end markers,
+    # so the writers finish and a failure is raised here instead of hanging
+    for thread in threads[2:]:
+        thread.join()
+    if errors:
+        raise errors[0]
 
-for i, row in enumerate(entire_dataset):
-    if (i+1) > num_rows:
-        break
+    elapsed = time.time() - start_time
+    print(f"Finished! Loaded {loaded} rows in {elapsed:.1f}s ({loaded / elapsed:.0f} rows/sec)")
 
-    row['emb'] = normalize_vector(row['emb'])
-    batch.append(row)
+    if args.create_index:
+        conn = psycopg2.connect(LANTERN_PG_URI)
+        create_index(conn, args.quantization)
+        conn.close()
 
-    if len(batch) == batch_size:
-        batch_end = time.time()
-        print(f"Batch# {batch_n} took {batch_end - batch_start}s to gather")
+    if args.create_bq_index:
+        conn = psycopg2.connect(LANTERN_PG_URI)
+        create_bq_index(conn, args.batch_size)
+        conn.close()
 
-        print("Upserting batch...")
-        elapsed = batch_insert(batch)
-        print(f"Finished upserting batch! Took {elapsed}s")
 
-        batch = []
-        batch_n += 1
-        batch_start = time.time()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import { createHash } from "crypto";
+
+// LRU cache with an optional time to live. Map keeps insertion order, so the
+// first key is always the least recently used one.
+export class LRUCache {
+  constructor({ maxEntries, ttlMs = 0 }) {
+    this.maxEntries = maxEntries;
+    this.ttlMs = ttlMs;
+    this.entries = new Map();
+    this.hits = 0;
+    this.misses = 0;
+    this.evictions = 0;
+    this.expirations = 0;
+  }
+
+  get(key) {
+    const entry = this.entries.get(key);
+    if (entry === undefined) {
+      this.misses++;
+      return undefined;
+    }
+    if (this.ttlMs && entry.expiresAt <= Date.now()) {
+      this.entries.delete(key);
+      this.expirations++;
+      this.misses++;
+      return undefined;
+    }
+    // move to the most recently used position
+    this.entries.delete(key);
+    this.entries.set(key, entry);
+    this.hits++;
+    return entry.value;
+  }
+
+  set(key, value) {
+    this.entries.delete(key);
+    this.entries.set(key, { value, expiresAt: Date.now() + this.ttlMs });
+    while (this.entries.size > this.maxEntries) {
+      this.entries.delete(this.entries.keys().next().value);
+      this.evictions++;
+    }
+  }
+
+  stats() {
+    const lookups = this.hits + this.misses;
+    return {
+      size: this.entries.size,
+      maxEntries: this.maxEntries,
+      ttlMs: this.ttlMs,
+      hits: this.hits,
+      misses: this.misses,
+      hitRate: lookups ? this.hits / lookups : 0,
+      evictions: this.evictions,
+      expirations: this.expirations,
+    };
+  }
+}
+
+// Cohere embeddings of a query text never change, so they are only evicted by size
+export const embeddingCache = new LRUCache({
+  maxEntries: parseInt(process.env.EMBEDDING_CACHE_SIZE || "10000"),
+});
+
+// Search results are cached briefly so popular searches do not re-run the same KNN query
+export const resultCache = new LRUCache({
+  maxEntries: parseInt(process.env.RESULT_CACHE_SIZE || "1000"),
+  ttlMs: parseInt(process.env.RESULT_CACHE_TTL_MS || "60000"),
+});
+
+export function normalizeQueryText(query) {
+  return query.trim().toLowerCase().replace(/\s+/g, " ");
+}
+
+export function resultCacheKey(embedding, limit) {
+  const hash = createHash("sha256")
+    .update(Buffer.from(new Float32Array(embedding).buffer))
+    .digest("hex");
+  return `${hash}:${limit}`;
+}
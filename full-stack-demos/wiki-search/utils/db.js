@@ -4,4 +4,34 @@ const pool = new Pool({
   connectionString: process.env.LANTERN_DB_PG_URI,
 });
 
-export const DBQuery = (text, params) => pool.query(text, params);
+// Two-stage search pulls 10 * TWO_STAGE_OVERSAMPLE candidates from the hamming
+// index, so ef is raised to let the index scan return all of them
+const TWO_STAGE_OVERSAMPLE = parseInt(process.env.TWO_STAGE_OVERSAMPLE || "0", 10);
+const SESSION_SETTINGS = TWO_STAGE_OVERSAMPLE
+  ? `SET enable_seqscan = false; SET lantern_hnsw.ef = ${Math.max(10 * TWO_STAGE_OVERSAMPLE, 64)};`
+  : "SET enable_seqscan = false;";
+
+// Session settings are applied once when the pool opens a connection instead of
+// before every search. A failure is logged here, and DBQuery releases the client
+// with the error so the pool discards that connection.
+pool.on("connect", (client) => {
+  client.sessionReady = client
+    .query(SESSION_SETTINGS)
+    .catch((error) => {
+      console.error("Failed to apply session settings:", error);
+      throw error;
+    });
+});
+
+export const DBQuery = async (text, params) => {
+  const client = await pool.connect();
+  try {
+    await client.sessionReady;
+    const result = await client.query(text, params);
+    client.release();
+    return result;
+  } catch (error) {
+    client.release(error);
+    throw error;
+  }
+};
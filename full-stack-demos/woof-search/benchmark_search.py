@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import time
+
+import numpy as np
+import psycopg2
+
+from search_service import DB_URI, TABLE_NAME, SearchService
+
+
+def load_query_vectors(n):
+    # existing image embeddings are used as queries so the benchmark does not need CLIP
+    conn = psycopg2.connect(DB_URI)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT vector FROM {TABLE_NAME} ORDER BY random() LIMIT %s;", (n,))
+    vectors = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    return vectors
+
+
+def legacy_search(vec):
+    # the previous request path: a new connection and an inlined ARRAY literal per search
+    conn = psycopg2.connect(DB_URI)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT path, cos_dist(vector, ARRAY{vec}) AS dist FROM {TABLE_NAME} ORDER BY vector <-> ARRAY{vec} LIMIT 9;")
+    results = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return results
+
+
+async def run_level(search, vectors, concurrency, requests):
+    latencies = []
+    next_request = iter(range(requests))
+
+    async def client():
+        for i in next_request:
+            start = time.perf_counter()
+            await search(vectors[i % len(vectors)])
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return requests / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def exact_search(vec, limit=9):
+    # sequential scan with exact cos_dist, the reference for the recall of the indexed searches
+    conn = psycopg2.connect(DB_URI)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT path FROM {TABLE_NAME} ORDER BY cos_dist(vector, %s::real[]) LIMIT %s;", (vec, limit))
+    results = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    return results
+
+
+async def mean_recall(search, vectors, limit=9):
+    recalls = []
+    for vec in vectors:
+        found = {row[0] for row in await search(vec)}
+        recalls.append(len(found.intersection(exact_search(vec, limit))) / limit)
+    return np.mean(recalls)
+
+
+async def main(concurrency_levels, requests, legacy, oversample):
+    vectors = load_query_vectors(200)
+    service = SearchService(max_size=max(concurrency_levels), oversample=oversample)
+    await service.open()
+
+    async def legacy_search_async(vec):
+        return await asyncio.to_thread(legacy_search, vec)
+
+    search = legacy_search_async if legacy else service.search
+    mode = "legacy" if legacy else f"two-stage x{oversample}" if oversample else "pooled"
+    print(f"{mode} search, {requests} requests per level, recall@9 {await mean_recall(search, vectors[:50]):.3f}")
+    for concurrency in concurrency_levels:
+        rps, p50, p99 = await run_level(search, vectors, concurrency, requests)
+        print(f"concurrency {concurrency:>3}: {rps:8.1f} req/s, p50 {p50:7.2f}ms, p99 {p99:7.2f}ms")
+    await service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Requests/sec of the WoofSearch KNN query at several client concurrency levels")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--legacy", action="store_true", help="benchmark the old connection-per-request path instead")
+    parser.add_argument("--oversample", type=int, help="benchmark two-stage search with this oversampling factor")
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency, args.requests, args.legacy, args.oversample))
@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+def image_hash(image):
+    # content hash of the decoded pixels, so the same picture hits the cache however it was uploaded
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class BatchingEncoder:
+    # collects concurrent encode requests for up to max_wait_ms and runs them through CLIP as one batch.
+    # embeddings are kept in an LRU cache keyed by image content, and identical images that are
+    # being encoded at the same time share a single forward pass
+    def __init__(self, model, preprocess, device, max_batch_size=16, max_wait_ms=5, cache_size=1024):
+        self.model = model
+        self.preprocess = preprocess
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._queue = None
+        self._worker = None
+
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "batches": self.batches,
+            "mean_batch_size": self.misses / self.batches if self.batches else 0.0,
+            "cached": len(self._cache),
+        }
+
+    async def encode(self, image):
+        key = image_hash(image)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return self._cache[key]
+        if key in self._pending:
+            self.hits += 1
+            return await asyncio.shield(self._pending[key])
+
+        self.misses += 1
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            await self._queue.put((image, future))
+            embedding = await asyncio.shield(future)
+        finally:
+            self._pending.pop(key, None)
+
+        self._cache[key] = embedding
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return embedding
+
+    def _ensure_worker(self):
+        # the queue and worker task live on the loop that serves the first request
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _collect_batch(self):
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            self.batches += 1
+            try:
+                # the forward pass runs in a thread so the event loop keeps accepting requests
+                embeddings = await asyncio.to_thread(self._encode_batch, [image for image, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+    def _encode_batch(self, images):
+        tensor = torch.stack([self.preprocess(image) for image in images]).to(self.device)
+        with torch.no_grad():
+            features = self.model.encode_image(tensor)
+        return features.cpu().tolist()
@@ -1,14 +1,14 @@
+import argparse
+import os
 from pathlib import Path
 import torch
 import clip
 from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Subset
 from tqdm import tqdm
-import pickle
 
-# Directory where your images are stored
-root_dir = 'Images'
+from shards import ShardWriter
 
 # CLIP requires a specific preprocessing pipeline
 preprocess = Compose([
@@ -20,7 +20,6 @@ preprocess = Compose([
 
 # Use CUDA if available
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
 
 # A custom dataset to read images from a list of files
 class ImageDataset(Dataset):
@@ -38,60 +37,63 @@ class ImageDataset(Dataset):
             image = self.transform(image)
         return image, image_path
 
-# Function to get all image paths
+# Function to get all image paths, sorted so that a resumed run sees the same order
 def get_image_paths(directory):
-    return list(Path(directory).rglob('*.jpg')) + list(Path(directory).rglob('*.jpeg'))
+    return sorted(list(Path(directory).rglob('*.jpg')) + list(Path(directory).rglob('*.jpeg')))
 
-# Batch size for embedding
-batch_size = 32  # You can adjust this according to your GPU memory
-
-# Get all image file paths
-image_paths = get_image_paths(root_dir)
-print(image_paths)
-image_dataset = ImageDataset(image_paths, transform=preprocess)
-image_dataloader = DataLoader(image_dataset, batch_size=batch_size, shuffle=False)
-
-def process_and_embed_images(dataloader, model):
+def process_and_embed_images(dataloader, model, writer):
     model.eval()  # Put the model in evaluation mode
-    embeddings = []
-    paths = []
 
     with torch.no_grad():  # No need to track gradients
-        # Initialize the tqdm progress bar
         progress_bar = tqdm(dataloader, desc="Processing Images", mininterval=1)
         for images, image_paths in progress_bar:
-            images = images.to(device)
+            images = images.to(device, non_blocking=True)
             # Get the embeddings for this batch
             batch_embeddings = model.encode_image(images)
-            
-            embeddings.append(batch_embeddings.cpu())
-            paths.extend(image_paths)
-            
-            # Manually update the progress bar
-            progress_bar.update()
-            progress_bar.refresh()  # Force refresh the stdout
-            #sys.stdout.flush() 
-
-    # Concatenate all the embeddings from each batch into a single Tensor
-    embeddings = torch.cat(embeddings, dim=0)
-    return embeddings, paths
-
-
-# Process the images and get their embeddings
-embeddings, paths = process_and_embed_images(image_dataloader, model)
-
-embeddings_list = embeddings.tolist()
-paths_list = [str(path) for path in paths]
-
-# Pair each embedding with its corresponding path
-embeddings_paths_pairs = list(zip(embeddings_list, paths_list))
-
-print(embeddings_paths_pairs)
-
-# Serialize with pickle and save to a file
-with open('embeddings_paths_pairs.pkl', 'wb') as f:
-    pickle.dump(embeddings_paths_pairs, f)
-
 
-# At this point, `embeddings` is a Tensor containing all the image embeddings,
-# and `paths` is a list of image paths corresponding to these embeddings.
+            # embeddings are streamed to disk shard by shard, memory stays flat regardless of image count
+            writer.append(batch_embeddings.float().cpu().numpy(), image_paths)
+
+    writer.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed all images under a directory with CLIP into float32 shards")
+    # Directory where your images are stored
+    parser.add_argument("--root-dir", default="Images")
+    parser.add_argument("--out-dir", default="embeddings")
+    # You can adjust this according to your GPU memory
+    parser.add_argument("--batch-size", type=int, default=32)
+    # image decoding and preprocessing run in these worker processes
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+    # batches each worker decodes ahead of the model, bounds the memory used for prefetching
+    parser.add_argument("--prefetch-factor", type=int, default=2)
+    parser.add_argument("--shard-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    # loaded here and not at import, DataLoader workers import this module and only need the preprocessing
+    model, preprocess = clip.load("ViT-B/32", device=device)
+
+    # Get all image file paths
+    image_paths = get_image_paths(args.root_dir)
+    writer = ShardWriter(args.out_dir, shard_size=args.shard_size, model="ViT-B/32", image_count=len(image_paths))
+    if writer.completed:
+        print(f"Resuming after {writer.completed} of {len(image_paths)} images")
+
+    image_dataset = Subset(ImageDataset(image_paths, transform=preprocess), range(writer.completed, len(image_paths)))
+    image_dataloader = DataLoader(
+        image_dataset,
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor if args.num_workers > 0 else None,
+        pin_memory=device == "cuda",
+    )
+
+    # Process the images and stream their embeddings to args.out_dir
+    process_and_embed_images(image_dataloader, model, writer)
+    print(f"Wrote embeddings of {writer.completed} images to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
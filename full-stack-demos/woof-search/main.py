@@ -7,47 +7,32 @@ import clip
 
 import os
 
-import psycopg2
+from encoder import BatchingEncoder
+from search_service import SearchService
 
 # Initialize CLIP model
 device = "cuda" if torch.cuda.is_available() else "cpu"
 model, preprocess = clip.load("ViT-B/32", device=device)
 
-TABLE_NAME = "images"
+# WOOF_TWO_STAGE_OVERSAMPLE=4 searches the binary quantized codes from populate_db.py --create-bq-index
+# for 4x the results and re-ranks them on the full vectors
+oversample = os.environ.get("WOOF_TWO_STAGE_OVERSAMPLE")
+search_service = SearchService(oversample=int(oversample) if oversample else None)
+image_encoder = BatchingEncoder(model, preprocess, device)
 
 # Performs a vector search using lantern
-def single_search(vec):
-    conn = psycopg2.connect(
-        dbname="dog_images",
-        user="postgres",
-        password="password",
-        host="localhost",
-        port="5432" 
-    )
-
-    cursor = conn.cursor()
-
-    cursor.execute(f"SELECT path, cos_dist(vector, ARRAY{vec}) AS dist FROM {TABLE_NAME} ORDER BY vector <-> ARRAY{vec} LIMIT 9;")
-    results = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
-    return results
+async def single_search(vec):
+    return await search_service.search(vec)
 
 
-def process_image(uploaded_image):
+async def process_image(uploaded_image):
     start_time = time.time()
 
-    image = preprocess(uploaded_image).unsqueeze(0).to(device)
-
-    # Get vector embedding of the query
-    with torch.no_grad():
-        image_features = model.encode_image(image)
-
-    query_embedding = image_features.tolist()
+    # Get vector embedding of the query, batched with concurrent requests and cached by image content
+    query_embedding = await image_encoder.encode(uploaded_image)
 
     # Perform the vector search
-    search_results = single_search(query_embedding)
+    search_results = await single_search(query_embedding)
 
     gallery_items = [(path, f"Distance: {dist:.4f}") for path, dist in search_results]
 
@@ -1,35 +1,88 @@
+import argparse
 import pickle
-import psycopg2
+import time
 
-# Load the embeddings and paths from the .pkl file
-with open('embeddings_paths_pairs.pkl', 'rb') as f:
-    loaded_embeddings_paths_pairs = pickle.load(f)
+import numpy as np
+import psycopg
+import pyarrow as pa
+from pgpq import ArrowToPostgresBinaryEncoder
 
-
-# We use the dbname, user, and password that we specified above
-conn = psycopg2.connect(
-    dbname="dog_images",
-    user="postgres",
-    password="password",
-    host="localhost",
-    port="5432" # default port for Postgres
-)
+from quantize import create_binary_quantized
+from search_service import DB_URI, TABLE_NAME
+from shards import iter_shards
 
 # how we created the table in psql:
 #CREATE TABLE images (id SERIAL PRIMARY KEY, path text, vector real[]);
 
-TABLE_NAME = "images"
+SCHEMA = pa.schema([("path", pa.string()), ("vector", pa.list_(pa.float32()))])
+
+
+def iter_pickle(path):
+    # embeddings_paths_pairs.pkl written by earlier versions of generate_embeddings.py
+    with open(path, 'rb') as f:
+        loaded_embeddings_paths_pairs = pickle.load(f)
+    embeddings = np.array([embedding for embedding, _ in loaded_embeddings_paths_pairs], dtype=np.float32)
+    yield embeddings, [path for _, path in loaded_embeddings_paths_pairs]
+
+
+def iter_batches(source, batch_size):
+    # re-slices shards (or the pickle) into record batches of at most batch_size rows
+    chunks = iter_pickle(source) if source.endswith(".pkl") else iter_shards(source)
+    for embeddings, paths in chunks:
+        for start in range(0, len(paths), batch_size):
+            vectors = np.ascontiguousarray(embeddings[start:start + batch_size], dtype=np.float32)
+            offsets = np.arange(0, vectors.size + 1, vectors.shape[1], dtype=np.int32)
+            yield pa.RecordBatch.from_arrays(
+                [
+                    pa.array(paths[start:start + batch_size], type=pa.string()),
+                    pa.ListArray.from_arrays(pa.array(offsets), pa.array(vectors.ravel())),
+                ],
+                schema=SCHEMA,
+            )
+
+
+def copy_batch(conn, batch):
+    encoder = ArrowToPostgresBinaryEncoder(SCHEMA)
+    with conn.cursor() as cursor:
+        with cursor.copy(f"COPY {TABLE_NAME} (path, vector) FROM STDIN WITH (FORMAT BINARY)") as copy:
+            copy.write(encoder.write_header())
+            copy.write(encoder.write_batch(batch))
+            copy.write(encoder.finish())
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load image embeddings into Lantern with binary COPY")
+    parser.add_argument("--source", default="embeddings", help="shard directory from generate_embeddings.py, or a .pkl file")
+    parser.add_argument("--batch-size", type=int, default=50_000, help="rows per COPY and commit")
+    parser.add_argument("--create-index", action="store_true", help="build the HNSW index after loading")
+    parser.add_argument("--create-bq-index", action="store_true", help="build the binary quantized codes for two-stage search")
+    args = parser.parse_args()
+
+    with psycopg.connect(DB_URI) as conn:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_NAME} (id SERIAL PRIMARY KEY, path text, vector real[])")
+        conn.commit()
 
-# Get a new cursor
-cursor = conn.cursor()
+        rows = 0
+        start = time.time()
+        for batch in iter_batches(args.source, args.batch_size):
+            copy_batch(conn, batch)
+            rows += batch.num_rows
+            print(f"Loaded {rows} rows ({rows / (time.time() - start):.0f} rows/sec)")
+        # load throughput is measured before the optional index build, which is reported on its own
+        elapsed = time.time() - start
+        print(f"Loaded {rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/sec)")
 
+        if args.create_index:
+            # building the index once after loading is much faster than maintaining it during the load
+            index_start = time.time()
+            conn.execute(f"CREATE INDEX ON {TABLE_NAME} USING lantern_hnsw (vector dist_cos_ops)")
+            conn.commit()
+            print(f"Built the HNSW index in {time.time() - index_start:.1f}s")
 
-for embedding, path in loaded_embeddings_paths_pairs:
-   cursor.execute(f"INSERT INTO {TABLE_NAME}(path, vector) VALUES (%s, %s);", (path, embedding))
-    
+    if args.create_bq_index:
+        create_binary_quantized(DB_URI, TABLE_NAME)
 
-conn.commit()
-cursor.close()
 
-# index creation command:
-# CREATE INDEX on images USING hnsw (vector dist_cos_ops);
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import time
+
+import numpy as np
+import psycopg
+import pyarrow as pa
+from pgpq import ArrowToPostgresBinaryEncoder
+
+# binary quantized copy of the images table for two-stage search: images_bq holds a 1-bit sign code per
+# dimension with a hamming lantern_hnsw index, images_bq_center the per-dimension center the codes are
+# taken around. SearchService(oversample=...) pulls candidates from this index and re-ranks them with
+# cos_dist on the full vectors
+
+SCHEMA = pa.schema([("id", pa.int32()), ("code", pa.list_(pa.int32()))])
+
+
+def binary_quantize(vectors, center):
+    # one bit per dimension, set when the value is above the center, packed into int32 words so the
+    # codes are stored as integer[] and compared with <+> (hamming)
+    bits = np.atleast_2d(np.asarray(vectors, dtype=np.float32)) > center
+    words = -(-bits.shape[1] // 32)
+    bits = np.pad(bits, ((0, 0), (0, words * 32 - bits.shape[1])))
+    return np.ascontiguousarray(np.packbits(bits, axis=1, bitorder="little")).view("<i4")
+
+
+def bq_table(table_name):
+    return f"{table_name}_bq"
+
+
+def create_binary_quantized(db_uri, table_name, batch_size=50_000, sample_rows=100_000):
+    bq = bq_table(table_name)
+    start = time.time()
+    rows = 0
+    # images are read through a server-side cursor on one connection while COPY runs on another
+    with psycopg.connect(db_uri) as read_conn, psycopg.connect(db_uri) as conn:
+        sample = read_conn.execute(f"SELECT vector FROM {table_name} ORDER BY random() LIMIT %s", (sample_rows,)).fetchall()
+        center = np.asarray([row[0] for row in sample], dtype=np.float32).mean(axis=0)
+        words = binary_quantize(center, center).shape[1]
+
+        conn.execute(f"DROP TABLE IF EXISTS {bq}, {bq}_center")
+        conn.execute(f"CREATE TABLE {bq}_center (center real[])")
+        conn.execute(f"INSERT INTO {bq}_center VALUES (%s)", ([float(v) for v in center],))
+        conn.execute(f"CREATE TABLE {bq} (id integer PRIMARY KEY, code integer[])")
+
+        with read_conn.cursor(name="bq_scan") as scan, conn.cursor() as cursor:
+            scan.execute(f"SELECT id, vector FROM {table_name}")
+            with cursor.copy(f"COPY {bq} (id, code) FROM STDIN WITH (FORMAT BINARY)") as copy:
+                encoder = ArrowToPostgresBinaryEncoder(SCHEMA)
+                copy.write(encoder.write_header())
+                while batch := scan.fetchmany(batch_size):
+                    ids, vectors = zip(*batch)
+                    codes = binary_quantize(np.asarray(vectors, dtype=np.float32), center)
+                    copy.write(encoder.write_batch(pa.RecordBatch.from_arrays(
+                        [
+                            pa.array(ids, pa.int32()),
+                            pa.FixedSizeListArray.from_arrays(pa.array(codes.ravel()), words).cast(pa.list_(pa.int32())),
+                        ],
+                        schema=SCHEMA,
+                    )))
+                    rows += len(batch)
+                copy.write(encoder.finish())
+        conn.execute(f"CREATE INDEX ON {bq} USING lantern_hnsw (code dist_hamming_ops) WITH (dim={words})")
+        conn.commit()
+        # memory saved: the hamming index next to the HNSW index on the full vectors
+        sizes = dict(conn.execute(
+            """
+            SELECT i.indrelid::regclass::text, sum(pg_relation_size(i.indexrelid))
+            FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_am am ON am.oid = c.relam
+            WHERE i.indrelid IN (%s::regclass, %s::regclass) AND am.amname = 'lantern_hnsw'
+            GROUP BY 1
+            """,
+            (table_name, bq),
+        ).fetchall())
+    print(f"Built {bq} with {rows} codes of {words * 32} bits in {time.time() - start:.1f}s")
+    for name, size in sizes.items():
+        print(f"HNSW index size on {name}: {size / 1024**2:.1f}MB")
+    return center
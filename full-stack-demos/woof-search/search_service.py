@@ -0,0 +1,81 @@
+import asyncio
+import os
+
+import numpy as np
+from psycopg_pool import AsyncConnectionPool
+
+from quantize import binary_quantize, bq_table
+
+TABLE_NAME = "images"
+
+# same database as populate_db.py, override with WOOF_DB_URI
+DB_URI = os.environ.get(
+    "WOOF_DB_URI", "dbname=dog_images user=postgres password=password host=localhost port=5432"
+)
+
+# the distance is selected once and reused by ORDER BY, so the index distance is what gets returned
+# instead of computing cos_dist a second time per row
+SEARCH_QUERY = f"SELECT path, vector <=> %b::real[] AS dist FROM {TABLE_NAME} ORDER BY dist LIMIT %b"
+
+# two-stage search over the binary codes built by populate_db.py --create-bq-index: the hamming index
+# returns limit * oversample candidates and the exact cos_dist on their full vectors picks the results
+TWO_STAGE_QUERY = f"""
+    WITH candidates AS MATERIALIZED (
+        SELECT id FROM {bq_table(TABLE_NAME)} ORDER BY code <+> %b::integer[] LIMIT %b
+    )
+    SELECT i.path, cos_dist(i.vector, %b::real[]) AS dist
+    FROM candidates c JOIN {TABLE_NAME} i USING (id)
+    ORDER BY dist
+    LIMIT %b"""
+
+
+class SearchService:
+    # pooled, async KNN search over the images table. the pool is opened lazily on the event loop
+    # that serves the first request, so it works inside Gradio's loop as well as in scripts.
+    # with oversample set, searches run in two stages over the binary quantized codes
+    def __init__(self, db_uri=DB_URI, min_size=2, max_size=16, limit=9, oversample=None):
+        self.limit = limit
+        self.oversample = oversample
+        self.center = None
+        self.pool = AsyncConnectionPool(
+            db_uri,
+            min_size=min_size,
+            max_size=max_size,
+            kwargs={"autocommit": True},
+            configure=self._configure if oversample else None,
+            open=False,
+        )
+        self._opened = False
+        self._open_lock = asyncio.Lock()
+
+    async def open(self):
+        async with self._open_lock:
+            if not self._opened:
+                await self.pool.open(wait=True)
+                if self.oversample:
+                    async with self.pool.connection() as conn:
+                        cur = await conn.execute(f"SELECT center FROM {bq_table(TABLE_NAME)}_center")
+                        self.center = np.asarray((await cur.fetchone())[0], dtype=np.float32)
+                self._opened = True
+
+    async def _configure(self, conn):
+        # the hamming scan has to be allowed to return all limit * oversample candidates
+        await conn.execute("SELECT set_config('lantern_hnsw.ef', %s, false)", (str(max(self.limit * self.oversample, 64)),))
+
+    async def close(self):
+        if self._opened:
+            await self.pool.close()
+            self._opened = False
+
+    async def search(self, vec, limit=None):
+        await self.open()
+        limit = limit or self.limit
+        vec = [float(v) for v in vec]
+        async with self.pool.connection() as conn:
+            # prepare=True keeps one server-side prepared statement per pooled connection
+            if self.oversample:
+                code = binary_quantize(vec, self.center)[0].tolist()
+                cur = await conn.execute(TWO_STAGE_QUERY, (code, limit * self.oversample, vec, limit), prepare=True)
+            else:
+                cur = await conn.execute(SEARCH_QUERY, (vec, limit), prepare=True)
+            return await cur.fetchall()
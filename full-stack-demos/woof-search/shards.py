@@ -0,0 +1,80 @@
+import json
+import os
+
+import numpy as np
+
+# embeddings are written as append-only float32 .npy shards next to a json file with their image paths.
+# manifest.json lists the finished shards, so an interrupted run resumes after the last one
+
+
+def _write_atomic(path, write):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"shards": [], "completed": 0}
+
+
+class ShardWriter:
+    def __init__(self, out_dir, shard_size=4096, **manifest_fields):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        os.makedirs(out_dir, exist_ok=True)
+        self.manifest = read_manifest(out_dir)
+        # resuming relies on the same inputs in the same order, e.g. the same model and number of images
+        if self.manifest["shards"]:
+            changed = {
+                key: (self.manifest.get(key), value)
+                for key, value in manifest_fields.items()
+                if self.manifest.get(key) != value
+            }
+            if changed:
+                raise ValueError(
+                    f"{out_dir} was written with different settings {changed} (stored, current), "
+                    "use a new output directory or remove it to start over"
+                )
+        self.manifest.update(manifest_fields)
+        self._embeddings = []
+        self._paths = []
+
+    @property
+    def completed(self):
+        # number of images whose embeddings are durably written
+        return self.manifest["completed"]
+
+    def append(self, embeddings, paths):
+        self._embeddings.append(np.asarray(embeddings, dtype=np.float32))
+        self._paths.extend(str(p) for p in paths)
+        if len(self._paths) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self._paths:
+            return
+        name = f"shard-{len(self.manifest['shards']):05d}"
+        embeddings = np.concatenate(self._embeddings)
+        _write_atomic(os.path.join(self.out_dir, f"{name}.npy"), lambda f: np.save(f, embeddings))
+        _write_atomic(os.path.join(self.out_dir, f"{name}.paths.json"), lambda f: f.write(json.dumps(self._paths).encode()))
+
+        # the manifest is updated last, a crash before this point only loses the unfinished shard
+        self.manifest["shards"].append({"name": name, "start": self.completed, "count": len(self._paths)})
+        self.manifest["completed"] += len(self._paths)
+        _write_atomic(os.path.join(self.out_dir, "manifest.json"), lambda f: f.write(json.dumps(self.manifest, indent=2).encode()))
+        self._embeddings = []
+        self._paths = []
+
+
+def iter_shards(out_dir, mmap=True):
+    # yields (embeddings, paths) per finished shard, embeddings are memory-mapped float32 arrays
+    for shard in read_manifest(out_dir)["shards"]:
+        embeddings = np.load(os.path.join(out_dir, f"{shard['name']}.npy"), mmap_mode="r" if mmap else None)
+        with open(os.path.join(out_dir, f"{shard['name']}.paths.json")) as f:
+            paths = json.load(f)
+        yield embeddings, paths
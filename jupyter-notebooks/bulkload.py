@@ -0,0 +1,167 @@
+import io
+from time import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from pgpq import ArrowToPostgresBinaryEncoder
+
+# bulk loading for the demo notebooks (movies, weather_data, videos_search, questions_answers).
+# files are parsed column-wise with pyarrow/numpy instead of line by line, and rows are written
+# with binary COPY, committing after every batch. works with psycopg2 and psycopg 3 connections
+
+# binary COPY needs the exact column types, so arrow columns are cast to the types of the target table
+ARROW_TYPES = {
+    "smallint": pa.int16(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "real": pa.float32(),
+    "double precision": pa.float64(),
+    "boolean": pa.bool_(),
+    "text": pa.string(),
+    "integer[]": pa.list_(pa.int32()),
+    "real[]": pa.list_(pa.float32()),
+    "double precision[]": pa.list_(pa.float64()),
+}
+
+
+def table_schema(conn, table_name, columns):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT attname, format_type(atttypid, atttypmod)
+            FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+            """,
+            (table_name,),
+        )
+        types = dict(cur.fetchall())
+    missing = [c for c in columns if c not in types]
+    if missing:
+        raise ValueError(f"{table_name} has no column(s) {missing}")
+    unsupported = {c: types[c] for c in columns if types[c] not in ARROW_TYPES}
+    if unsupported:
+        raise ValueError(f"Unsupported column types for binary COPY: {unsupported}")
+    return pa.schema([(c, ARROW_TYPES[types[c]]) for c in columns])
+
+
+def vectors_to_arrow(vectors):
+    # (n, dim) matrix -> list<float32> array without going through python lists
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    return pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel()), vectors.shape[1]).cast(pa.list_(pa.float32()))
+
+
+def parse_vector_strings(strings):
+    # "[0.1, 0.2, ...]" or "0.1,0.2,..." strings -> (n, dim) float32 matrix, all vectors must have the same length
+    strings = pc.utf8_trim(pa.array(strings, pa.string()), "[] \t\r\n")
+    values = pc.split_pattern(strings, ",")
+    lengths = pc.list_value_length(values).to_numpy(zero_copy_only=False)
+    if len(lengths) and (lengths != lengths[0]).any():
+        raise ValueError("Vectors have different lengths")
+    flat = pc.cast(pc.utf8_trim_whitespace(pc.list_flatten(values)), pa.float32()).to_numpy()
+    return flat.reshape(len(lengths), lengths[0] if len(lengths) else 0)
+
+
+def read_id_vectors(path, delimiter=":"):
+    # files with one "<id>:[v1,v2,...]" line per row, e.g. movie_recommender/movie_vectors.txt
+    table = pa_csv.read_csv(
+        path,
+        read_options=pa_csv.ReadOptions(column_names=["id", "vector"]),
+        parse_options=pa_csv.ParseOptions(delimiter=delimiter, quote_char=False),
+        convert_options=pa_csv.ConvertOptions(column_types={"id": pa.int64(), "vector": pa.string()}),
+    )
+    return table["id"].to_numpy(), parse_vector_strings(table["vector"].combine_chunks())
+
+
+def read_csv_vectors(path, vector_columns, **read_kwargs):
+    # csv file whose vector is spread over several numeric columns, returns (other columns, (n, dim) matrix)
+    table = pa_csv.read_csv(path, **read_kwargs)
+    vectors = np.column_stack([table[c].to_numpy().astype(np.float32) for c in vector_columns])
+    return table.drop(list(vector_columns)), vectors
+
+
+def read_movies(path, encoding="latin-1"):
+    # MovieLens movies.dat: "<id>::<title>::<genres>" per line, latin-1 encoded
+    lines = pa_csv.read_csv(
+        path,
+        read_options=pa_csv.ReadOptions(column_names=["line"], encoding=encoding),
+        parse_options=pa_csv.ParseOptions(delimiter="\x1f", quote_char=False),
+    )["line"].combine_chunks()
+    parts = pc.split_pattern(lines, "::", max_splits=2)
+    return {
+        "id": pc.cast(pc.list_element(parts, 0), pa.int64()).to_numpy(),
+        "title": pc.list_element(parts, 1),
+        "genres": pc.list_element(parts, 2),
+    }
+
+
+def _write_copy(conn, table_name, schema, data):
+    statement = f"COPY {table_name} ({', '.join(schema.names)}) FROM STDIN WITH (FORMAT BINARY)"
+    with conn.cursor() as cur:
+        if hasattr(cur, "copy_expert"):
+            cur.copy_expert(statement, io.BytesIO(data))
+        else:
+            with cur.copy(statement) as copy:
+                copy.write(data)
+
+
+def copy_columns(conn, table_name, columns, batch_size=50_000):
+    # columns maps column names to arrays of equal length; 2-d numpy arrays are written as vectors.
+    # every batch is its own COPY and commit, so an interrupted load keeps the batches before it
+    schema = table_schema(conn, table_name, list(columns))
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if isinstance(values, np.ndarray) and values.ndim == 2:
+            values = vectors_to_arrow(values)
+        arrays.append(pc.cast(pa.array(values) if not isinstance(values, (pa.Array, pa.ChunkedArray)) else values, field.type))
+    table = pa.Table.from_arrays(arrays, schema=schema)
+
+    rows = 0
+    t = time()
+    for batch in table.to_batches(max_chunksize=batch_size):
+        # an encoder cannot be restarted after finish(), each COPY gets its own
+        encoder = ArrowToPostgresBinaryEncoder(schema)
+        _write_copy(conn, table_name, schema, encoder.write_header() + encoder.write_batch(batch) + encoder.finish())
+        conn.commit()
+        rows += batch.num_rows
+        print(f"Wrote {rows}/{table.num_rows} rows to {table_name} ({rows / (time() - t):.0f} rows/sec)")
+    return rows
+
+
+def load_movies(conn, movies_path="movie_recommender/movies.dat", vectors_path="movie_recommender/movie_vectors.txt", table_name="movies", ids=None, vectors=None):
+    # movies joined with their embeddings by id, movies without an embedding are skipped.
+    # ids and vectors from an earlier read_id_vectors call are reused instead of parsing vectors_path again
+    movies = read_movies(movies_path)
+    if ids is None or vectors is None:
+        ids, vectors = read_id_vectors(vectors_path)
+    ids = np.asarray(ids)
+    order = np.argsort(ids)
+    pos = np.minimum(np.searchsorted(ids, movies["id"], sorter=order), len(ids) - 1)
+    found = ids[order[pos]] == movies["id"]
+    if not found.all():
+        print(f"skipping {(~found).sum()} movies without a vector")
+    mask = pa.array(found)
+    return copy_columns(
+        conn,
+        table_name,
+        {
+            "id": movies["id"][found],
+            "title": movies["title"].filter(mask),
+            "genres": movies["genres"].filter(mask),
+            "vector": vectors[order[pos[found]]],
+        },
+    )
+
+
+def load_weather(conn, df, table_name="weather_data"):
+    # the first column of df is the timestamp, all other columns form the vector
+    return copy_columns(
+        conn,
+        table_name,
+        {
+            "datetime": df.iloc[:, 0].astype(str).to_numpy(),
+            "vector": df.iloc[:, 1:].to_numpy(dtype=np.float32),
+        },
+    )
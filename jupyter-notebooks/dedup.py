@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import time
+
+import psycopg
+from psycopg_pool import ConnectionPool
+
+# near-duplicate detection for the imdb_reviews table of the semantic deduplication notebook.
+# instead of pulling every embedding into python, each batch of reviews looks up its nearest
+# neighbors through the lantern_hnsw index with a LATERAL join, and only pairs closer than the
+# threshold come back. batches of imdb_id ranges run on several connections at once
+
+NEIGHBORS_QUERY = """
+    SELECT a.imdb_id, nearest.imdb_id, nearest.dist
+    FROM imdb_reviews a
+    JOIN LATERAL (
+        SELECT b.imdb_id, b.review_embedding <=> a.review_embedding AS dist
+        FROM imdb_reviews b
+        ORDER BY dist
+        LIMIT %(neighbors)s
+    ) nearest ON true
+    WHERE a.imdb_id >= %(lo)s AND a.imdb_id < %(hi)s
+      AND nearest.imdb_id <> a.imdb_id
+      AND nearest.dist <= %(threshold)s"""
+
+
+def create_index(conn_string, m=None, ef_construction=None):
+    # the KNN lookups need a cosine lantern_hnsw index on review_embedding
+    options = {"m": m, "ef_construction": ef_construction}
+    with_q = ", ".join(f"{key}={int(value)}" for key, value in options.items() if value is not None)
+    with_q = f" WITH ({with_q})" if with_q else ""
+    with psycopg.connect(conn_string, autocommit=True) as conn:
+        conn.execute("CREATE EXTENSION IF NOT EXISTS lantern")
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS imdb_reviews_embedding_hnsw ON imdb_reviews USING lantern_hnsw (review_embedding dist_cos_ops){with_q}"
+        )
+
+
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, x):
+        parent = self.parent.setdefault(x, x)
+        if parent == x:
+            self.size.setdefault(x, 1)
+            return x
+        root = self.find(parent)
+        self.parent[x] = root
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size.pop(b)
+
+    def clusters(self):
+        groups = {}
+        for x in self.parent:
+            groups.setdefault(self.find(x), []).append(x)
+        return sorted((sorted(members) for members in groups.values()), key=len, reverse=True)
+
+
+def _neighbors_in_range(pool, lo, hi, threshold, neighbors):
+    with pool.connection() as conn:
+        return conn.execute(NEIGHBORS_QUERY, {"lo": lo, "hi": hi, "threshold": threshold, "neighbors": neighbors}).fetchall()
+
+
+def find_duplicates(conn_string, threshold=0.03, neighbors=5, batch_size=1000, workers=4, ef=None):
+    # returns the near-duplicate pairs (a, b, cos distance) with a < b, and the clusters of imdb_ids
+    # they form, largest first. `neighbors` is how many index neighbors are checked per review,
+    # the review itself included. ef raises lantern_hnsw.ef when neighbors is large
+    def configure(conn):
+        if ef is not None:
+            conn.execute("SELECT set_config('lantern_hnsw.ef', %s, false)", (str(int(ef)),))
+
+    with psycopg.connect(conn_string) as conn:
+        lo, hi = conn.execute("SELECT min(imdb_id), max(imdb_id) + 1 FROM imdb_reviews").fetchone()
+    if lo is None:
+        return [], []
+    ranges = [(start, min(start + batch_size, hi)) for start in range(lo, hi, batch_size)]
+
+    pairs = {}
+    clusters = UnionFind()
+    t = time()
+    pool = ConnectionPool(conn_string, min_size=workers, max_size=workers, kwargs={"autocommit": True}, configure=configure)
+    with pool, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_neighbors_in_range, pool, start, end, threshold, neighbors) for start, end in ranges]
+        for done, future in enumerate(as_completed(futures), 1):
+            # each pair can be found from both sides, keep the smaller distance
+            for a, b, dist in future.result():
+                key = (min(a, b), max(a, b))
+                pairs[key] = min(dist, pairs.get(key, dist))
+                clusters.union(a, b)
+            if done % 10 == 0 or done == len(futures):
+                print(f"{done}/{len(futures)} batches, {len(pairs)} pairs ({(done * batch_size) / (time() - t):.0f} reviews/sec)")
+
+    return sorted((a, b, dist) for (a, b), dist in pairs.items()), clusters.clusters()
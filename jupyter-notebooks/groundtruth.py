@@ -0,0 +1,199 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import numpy as np
+import psycopg
+
+import lib
+
+# exact filtered top-k on the client. passages are exported once into a directory of flat files:
+#   vectors.npy        (n, dim) float32 matrix, memory-mapped when searching
+#   ids.npy            passage id of every row
+#   sq_norms.npy       squared L2 norm of every row
+#   tag_offsets.npy,   metadata_tags of row i are tag_values[tag_offsets[i]:tag_offsets[i + 1]]
+#   tag_values.npy
+#   postings_*.npy     inverted index: sorted rows of every tag, in the same offsets/values layout
+# the output is a lib.GroundTruth directory, so lib.load_ground_truth(conn_string, cache_path=...) and
+# lib.compute_recalls work with it for any k
+
+
+def export_passages(conn_string, out_dir, batch_size=100_000):
+    os.makedirs(out_dir, exist_ok=True)
+    with psycopg.connect(conn_string) as conn:
+        n, dim = conn.execute("SELECT count(*), max(array_length(vector, 1)) FROM yfcc_passages").fetchone()
+        vectors = np.lib.format.open_memmap(os.path.join(out_dir, "vectors.npy"), mode="w+", dtype=np.float32, shape=(n, dim))
+        ids = np.empty(n, dtype=np.int64)
+        tag_counts = np.empty(n, dtype=np.int64)
+        tag_chunks = []
+
+        t = time()
+        row = 0
+        with conn.cursor(name="groundtruth_export") as cur:
+            cur.execute("SELECT id, vector, metadata_tags FROM yfcc_passages ORDER BY id")
+            while batch := cur.fetchmany(batch_size):
+                end = row + len(batch)
+                batch_ids, batch_vectors, batch_tags = zip(*batch)
+                ids[row:end] = batch_ids
+                vectors[row:end] = np.asarray(batch_vectors, dtype=np.float32)
+                tag_counts[row:end] = [len(tags or ()) for tags in batch_tags]
+                tag_chunks.append(np.fromiter((tag for tags in batch_tags for tag in tags or ()), dtype=np.int32))
+                row = end
+                print(f"Exported {row}/{n} passages ({row / (time() - t):.0f} rows/sec)")
+    vectors.flush()
+
+    tag_offsets = np.concatenate([[0], np.cumsum(tag_counts)])
+    tag_values = np.concatenate(tag_chunks) if tag_chunks else np.empty(0, dtype=np.int32)
+    # inverted index: a stable sort by tag keeps the rows of each tag in ascending order
+    tag_rows = np.repeat(np.arange(n, dtype=np.int64), tag_counts)
+    order = np.argsort(tag_values, kind="stable")
+    posting_tags, posting_counts = np.unique(tag_values[order], return_counts=True)
+
+    np.save(os.path.join(out_dir, "ids.npy"), ids)
+    np.save(os.path.join(out_dir, "sq_norms.npy"), np.einsum("ij,ij->i", vectors, vectors))
+    np.save(os.path.join(out_dir, "tag_offsets.npy"), tag_offsets)
+    np.save(os.path.join(out_dir, "tag_values.npy"), tag_values)
+    np.save(os.path.join(out_dir, "postings_tags.npy"), posting_tags)
+    np.save(os.path.join(out_dir, "postings_offsets.npy"), np.concatenate([[0], np.cumsum(posting_counts)]))
+    np.save(os.path.join(out_dir, "postings_rows.npy"), tag_rows[order])
+    print(f"Exported {n} passages with {len(posting_tags)} distinct tags to {out_dir}")
+
+
+class PassageStore:
+    def __init__(self, path):
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.vectors = load("vectors")
+        self.ids = load("ids")
+        self.sq_norms = np.asarray(load("sq_norms"))
+        self.postings_tags = np.asarray(load("postings_tags"))
+        self.postings_offsets = np.asarray(load("postings_offsets"))
+        self.postings_rows = load("postings_rows")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows_with_tags(self, tags):
+        # sorted rows whose metadata_tags contain all of tags, None when there is no filter
+        if not tags:
+            return None
+        # intersecting the shortest postings first keeps the intermediate results small
+        postings = []
+        for tag in tags:
+            i = np.searchsorted(self.postings_tags, tag)
+            if i == len(self.postings_tags) or self.postings_tags[i] != tag:
+                return np.empty(0, dtype=np.int64)
+            postings.append(self.postings_rows[self.postings_offsets[i]:self.postings_offsets[i + 1]])
+        rows = None
+        for posting in sorted(postings, key=len):
+            rows = np.asarray(posting) if rows is None else np.intersect1d(rows, posting, assume_unique=True)
+        return rows
+
+
+def _merge_topk(best_dists, best_rows, dists, rows, k):
+    dists = np.concatenate([best_dists, dists])
+    rows = np.concatenate([best_rows, rows])
+    if len(dists) > k:
+        keep = np.argpartition(dists, k - 1)[:k]
+        dists, rows = dists[keep], rows[keep]
+    return dists, rows
+
+
+def _exact_rerank(store, q_vector, rows, k):
+    # distances from the q.p expansion lose precision in float32, so the final order is
+    # decided on exact float64 differences of the few surviving rows
+    rows = np.sort(rows)
+    diff = np.asarray(store.vectors[rows], dtype=np.float64) - q_vector
+    dists = np.einsum("ij,ij->i", diff, diff)
+    order = np.lexsort((rows, dists))[:k]
+    return rows[order], dists[order]
+
+
+def _search_chunk(store, q_vectors, candidates, k, block_rows, sparse_limit):
+    # exact top-k for a chunk of queries. queries whose filter matches at most sparse_limit rows gather
+    # their candidates directly; all others share one blocked pass over the passage matrix, where each
+    # block costs a single (queries x block) matrix multiplication
+    n = len(store)
+    slack = 2 * k
+    results = [None] * len(q_vectors)
+    dense = []
+    for j, rows in enumerate(candidates):
+        if rows is not None and len(rows) <= sparse_limit:
+            rows = np.asarray(rows)
+            dists = store.sq_norms[rows] - 2 * (np.asarray(store.vectors[rows]) @ q_vectors[j])
+            results[j] = rows[np.argpartition(dists, slack - 1)[:slack]] if len(rows) > slack else rows
+        else:
+            dense.append(j)
+
+    if dense:
+        dense_q = q_vectors[dense]
+        best = [(np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)) for _ in dense]
+        for start in range(0, n, block_rows):
+            end = min(start + block_rows, n)
+            block = np.asarray(store.vectors[start:end])
+            dists = store.sq_norms[start:end][None, :] - 2 * (dense_q @ block.T)
+            for i, j in enumerate(dense):
+                rows = candidates[j]
+                if rows is None:
+                    block_rows_j = np.arange(start, end)
+                    block_dists = dists[i]
+                else:
+                    lo, hi = np.searchsorted(rows, [start, end])
+                    block_rows_j = np.asarray(rows[lo:hi])
+                    block_dists = dists[i, block_rows_j - start]
+                best[i] = _merge_topk(*best[i], block_dists, block_rows_j, slack)
+        for i, j in enumerate(dense):
+            results[j] = best[i][1]
+
+    return [_exact_rerank(store, q_vectors[j].astype(np.float64), rows, k) for j, rows in enumerate(results)]
+
+
+def compute_ground_truth(store, queries, k=100, workers=None, chunk_size=64, block_rows=262_144, sparse_limit=262_144):
+    # queries is a list of (id, vector, tags) as returned by lib.fetch_queries.
+    # chunks of queries run on a thread pool, numpy releases the GIL inside the matrix products
+    workers = workers or os.cpu_count()
+    query_ids = np.array([q[0] for q in queries], dtype=np.int64)
+    q_vectors = np.asarray([q[1] for q in queries], dtype=np.float32)
+    candidates = [store.rows_with_tags(q[2]) for q in queries]
+    selectivity = np.array([len(store) if rows is None else len(rows) for rows in candidates], dtype=np.int64)
+
+    chunks = range(0, len(queries), chunk_size)
+    t = time()
+    neighbors = np.full((len(queries), k), -1, dtype=np.int64)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            start: executor.submit(
+                _search_chunk, store, q_vectors[start:start + chunk_size], candidates[start:start + chunk_size], k, block_rows, sparse_limit
+            )
+            for start in chunks
+        }
+        done = 0
+        for start, future in futures.items():
+            for offset, (rows, _) in enumerate(future.result()):
+                neighbors[start + offset, :len(rows)] = store.ids[rows]
+            done += min(chunk_size, len(queries) - start)
+            print(f"{done}/{len(queries)} queries ({done / (time() - t):.1f} queries/sec)")
+
+    return lib.GroundTruth(query_ids, neighbors, selectivity)
+
+
+def generate_ground_truth(conn_string, passages_dir, out_dir, k=100, limit=None, offset=0, **kwargs):
+    # exports the passages on first use, computes exact top-k for the queries in yfcc_queries and
+    # writes the result where lib.load_ground_truth(conn_string, cache_path=out_dir) picks it up
+    if not os.path.exists(os.path.join(passages_dir, "ids.npy")):
+        export_passages(conn_string, passages_dir)
+    store = PassageStore(passages_dir)
+
+    with lib.get_conn(conn_string) as conn:
+        if limit is None:
+            limit = conn.execute("SELECT count(*) FROM yfcc_queries").fetchone()[0] - offset
+        queries = lib.fetch_queries(conn, range(offset, offset + limit))
+
+    ground_truth = compute_ground_truth(store, queries, k=k, **kwargs)
+    ground_truth.save(out_dir)
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"k": k, "queries": len(queries), "passages": len(store)}, f)
+    print(f"wrote exact top-{k} for {len(queries)} queries to {out_dir}")
+    return ground_truth
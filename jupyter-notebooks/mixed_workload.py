@@ -0,0 +1,220 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+import numpy as np
+
+import lib
+
+# searches against a live lantern_hnsw index while passages are inserted into yfcc_passages.
+# inserts and searches follow open-loop schedules at fixed rates: latency is measured from the time a
+# request was due, so a stalled search also counts the requests queued behind it. recall is sampled
+# against an exact search on the current table contents, since the dataset ground truth goes stale
+# as soon as rows are added
+
+
+def _paced(rate, duration, stop):
+    # yields the due time of every request of a schedule with `rate` requests per second
+    interval = 1.0 / rate
+    start = perf_counter()
+    i = 0
+    while not stop.is_set():
+        due = start + i * interval
+        if due - start >= duration:
+            return
+        delay = due - perf_counter()
+        if delay > 0:
+            sleep(delay)
+        yield due
+        i += 1
+
+
+def _sample_passages(conn, rows):
+    # base vectors and tags for generated inserts, so new rows look like the existing data
+    sampled = conn.execute(
+        "SELECT vector, metadata_tags FROM yfcc_passages TABLESAMPLE SYSTEM (1) LIMIT %s", (rows,)
+    ).fetchall() or conn.execute("SELECT vector, metadata_tags FROM yfcc_passages LIMIT %s", (rows,)).fetchall()
+    return np.asarray([r[0] for r in sampled], dtype=np.float32), [list(r[1] or []) for r in sampled]
+
+
+def _insert_worker(pool, rate, batch_size, duration, stop, seed, first_id, log):
+    # ids are assigned from first_id on: the loaders write explicit ids, so the id sequence of
+    # yfcc_passages never moved and its defaults would collide with existing rows
+    rng = np.random.default_rng(seed)
+    next_id = first_id
+    with pool.connection() as conn:
+        vectors, tags = _sample_passages(conn, 10_000)
+        noise = vectors.std(axis=0) * 0.1
+        rows = 0
+        for due in _paced(rate / batch_size, duration, stop):
+            picks = rng.integers(0, len(vectors), batch_size)
+            batch = [
+                (next_id + i, (vectors[p] + rng.normal(0, noise)).astype(np.float32), tags[p])
+                for i, p in enumerate(picks)
+            ]
+            with conn.transaction(), conn.cursor(binary=True) as cur:
+                cur.executemany("INSERT INTO yfcc_passages (id, vector, metadata_tags) VALUES (%b, %b, %b::integer[])", batch)
+            next_id += batch_size
+            rows += batch_size
+            log.append({"t": perf_counter(), "kind": "insert", "rows": batch_size, "latency_ms": (perf_counter() - due) * 1000})
+    return rows
+
+
+def _search_worker(pool, queries, rate, duration, stop, k, log):
+    with pool.connection() as conn:
+        for i, due in enumerate(_paced(rate, duration, stop)):
+            _, q_vector, tags = queries[i % len(queries)]
+            lib.vector_search_prepared(conn, q_vector, tags, k=k)
+            log.append({"t": perf_counter(), "kind": "search", "latency_ms": (perf_counter() - due) * 1000})
+
+
+def _recall_worker(pool, queries, interval, duration, stop, k, sample, seed, log):
+    # every `interval` seconds, compares HNSW results of `sample` queries with an exact search
+    rng = np.random.default_rng(seed)
+    with pool.connection() as conn:
+        for _ in _paced(1.0 / interval, duration, stop):
+            recalls = []
+            for i in rng.choice(len(queries), min(sample, len(queries)), replace=False):
+                _, q_vector, tags = queries[i]
+                approx = {row[0] for row in lib.vector_search_prepared(conn, q_vector, tags, k=k)}
+                with conn.cursor(binary=True) as cur:
+                    exact = [row[0] for row in cur.execute(lib._EXACT_SEARCH_QUERY, (q_vector, list(tags), k)).fetchall()]
+                recalls.append(len(approx.intersection(exact)) / len(exact) if exact else 1.0)
+            log.append({"t": perf_counter(), "kind": "recall", "recall": float(np.mean(recalls))})
+
+
+# the tag statistics trigger from lib.create_tag_stats only counts inserts, so the deleted rows are
+# subtracted in the same statement that deletes them
+_CLEANUP_WITH_TAG_STATS = """
+    WITH deleted AS (
+        DELETE FROM yfcc_passages WHERE id > %(max_id)s RETURNING metadata_tags
+    ), tags AS (
+        UPDATE yfcc_tag_stats s SET passages = s.passages - d.passages
+        FROM (SELECT tag, count(*) AS passages FROM deleted, unnest(metadata_tags) tag GROUP BY tag) d
+        WHERE s.tag = d.tag
+    )
+    UPDATE yfcc_tag_pair_stats p SET passages = p.passages - d.passages
+    FROM (
+        SELECT s.tag_a, s.tag_b, count(*) AS passages
+        FROM yfcc_tag_pair_stats s
+        JOIN deleted r ON r.metadata_tags @> ARRAY[s.tag_a, s.tag_b]
+        GROUP BY s.tag_a, s.tag_b
+    ) d
+    WHERE p.tag_a = d.tag_a AND p.tag_b = d.tag_b"""
+
+
+def _cleanup(conn_string, max_id):
+    # removes the inserted rows and vacuums them away, so the next run of a sweep starts from the
+    # same heap and index instead of one full of dead tuples
+    with lib.get_conn(conn_string) as conn:
+        if conn.execute("SELECT to_regclass('yfcc_tag_stats') IS NOT NULL").fetchone()[0]:
+            conn.execute(_CLEANUP_WITH_TAG_STATS, {"max_id": max_id})
+        else:
+            conn.execute("DELETE FROM yfcc_passages WHERE id > %s", (max_id,))
+        conn.execute("VACUUM (ANALYZE) yfcc_passages")
+    lib._tag_stats_cache.pop(conn_string, None)
+
+
+def _summarize(log, start, window):
+    # per time window: inserted rows, search count and percentiles, and the sampled recall
+    windows = {}
+    for event in log:
+        w = windows.setdefault(int((event["t"] - start) // window), {"rows": 0, "search_ms": [], "recall": []})
+        if event["kind"] == "insert":
+            w["rows"] += event["rows"]
+        elif event["kind"] == "search":
+            w["search_ms"].append(event["latency_ms"])
+        else:
+            w["recall"].append(event["recall"])
+    report = []
+    for index in sorted(windows):
+        w = windows[index]
+        report.append({
+            "start_s": index * window,
+            "inserts_per_s": w["rows"] / window,
+            "searches": len(w["search_ms"]),
+            "search_p50_ms": float(np.percentile(w["search_ms"], 50)) if w["search_ms"] else None,
+            "search_p99_ms": float(np.percentile(w["search_ms"], 99)) if w["search_ms"] else None,
+            "recall": float(np.mean(w["recall"])) if w["recall"] else None,
+        })
+    return report
+
+
+def run_mixed_workload(
+    conn_string,
+    insert_rate=500,
+    search_rate=50,
+    duration=60,
+    insert_batch=50,
+    search_threads=4,
+    k=10,
+    limit=1000,
+    recall_interval=10,
+    recall_sample=20,
+    window=10,
+    cleanup=True,
+    seed=0,
+):
+    # insert_rate is in rows per second, search_rate in searches per second over all search threads.
+    # with insert_rate=0 this is the read-only baseline. with cleanup=True the inserted rows are deleted and vacuumed afterwards
+    with lib.get_conn(conn_string) as conn:
+        queries = lib.fetch_queries(conn, range(limit))
+        max_id = conn.execute("SELECT coalesce(max(id), 0) FROM yfcc_passages").fetchone()[0]
+
+    pool = lib.get_pool(conn_string, size=search_threads + 2)
+    log = []
+    stop = threading.Event()
+
+    def workload():
+        with ThreadPoolExecutor(max_workers=search_threads + 2) as executor:
+            futures = [
+                executor.submit(_search_worker, pool, queries[w::search_threads], search_rate / search_threads, duration, stop, k, log)
+                for w in range(search_threads)
+            ]
+            futures.append(executor.submit(_recall_worker, pool, queries, recall_interval, duration, stop, k, recall_sample, seed, log))
+            if insert_rate > 0:
+                futures.append(executor.submit(_insert_worker, pool, insert_rate, insert_batch, duration, stop, seed, max_id + 1, log))
+            try:
+                for future in futures:
+                    future.result()
+            finally:
+                stop.set()
+
+    start = perf_counter()
+    _, wal_bytes, elapsed = lib.wal_movement(conn_string, workload)
+
+    inserted = sum(e["rows"] for e in log if e["kind"] == "insert")
+    searches = np.array([e["latency_ms"] for e in log if e["kind"] == "search"])
+    recalls = [e["recall"] for e in log if e["kind"] == "recall"]
+    result = {
+        "insert_rate": insert_rate,
+        "search_rate": search_rate,
+        "elapsed_s": elapsed,
+        "rows_inserted": inserted,
+        "insert_throughput": inserted / elapsed,
+        "searches": len(searches),
+        "search_p50_ms": float(np.percentile(searches, 50)) if len(searches) else None,
+        "search_p99_ms": float(np.percentile(searches, 99)) if len(searches) else None,
+        "recall_first": recalls[0] if recalls else None,
+        "recall_last": recalls[-1] if recalls else None,
+        "wal_bytes": wal_bytes,
+        "wal_bytes_per_row": wal_bytes / inserted if inserted else None,
+        "windows": _summarize(log, start, window),
+    }
+    print(f"insert rate {insert_rate}/s, search rate {search_rate}/s: {result['insert_throughput']:.0f} rows/s inserted, "
+          f"search p99 {result['search_p99_ms']}ms, recall {result['recall_first']} -> {result['recall_last']}, "
+          f"WAL {wal_bytes / 1024**2:.1f}MB")
+
+    if cleanup and inserted:
+        _cleanup(conn_string, max_id)
+    return result
+
+
+def run_write_load_sweep(conn_string, insert_rates=(0, 100, 1000, 5000), output="mixed_workload.json", **kwargs):
+    # search latency and recall at increasing insert rates, the first rate is the read-only baseline
+    results = [run_mixed_workload(conn_string, insert_rate=rate, **kwargs) for rate in insert_rates]
+    with open(output, "w") as f:
+        json.dump(results, f)
+    print(f"wrote {len(results)} runs to {output}")
+    return results
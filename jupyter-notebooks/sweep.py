@@ -0,0 +1,153 @@
+import json
+from itertools import product
+from time import time
+
+import numpy as np
+import psycopg
+
+import lib
+
+
+def _drop_index(conn_string, name):
+    lib.run_query(conn_string, f"DROP INDEX IF EXISTS {name}")
+
+
+def _hnsw_indexes(conn_string):
+    with psycopg.connect(conn_string) as conn:
+        rows = conn.execute(
+            """
+            SELECT c.relname
+            FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_am am ON am.oid = c.relam
+            WHERE i.indrelid = 'yfcc_passages'::regclass AND am.amname = 'lantern_hnsw'
+            """
+        ).fetchall()
+    return [r[0] for r in rows]
+
+
+def _plan_indexes(plan):
+    names = [plan["Index Name"]] if "Index Name" in plan else []
+    for child in plan.get("Plans", []):
+        names += _plan_indexes(child)
+    return names
+
+
+def check_index_used(conn, name, query, k=10):
+    # the grid point is only valid if the planner actually searches the index that was just built
+    _, q_vector, tags = query
+    plan = conn.execute(f"EXPLAIN (FORMAT JSON) {lib._search_query()}", (q_vector, list(tags), k)).fetchone()[0][0]["Plan"]
+    used = _plan_indexes(plan)
+    if name not in used:
+        raise RuntimeError(f"search does not use {name} (plan uses {used or 'no index'})")
+
+
+def build_index(conn_string, m, ef_construction):
+    # builds a lantern_hnsw index with the given parameters, returns (name, build time, size in bytes)
+    name = f"yfcc_passages_hnsw_m{m}_efc{ef_construction}"
+    _drop_index(conn_string, name)
+    t = time()
+    lib.create_index(conn_string, m=m, ef_construction=ef_construction, name=name)
+    build_time = time() - t
+    with psycopg.connect(conn_string) as conn:
+        size = conn.execute("SELECT pg_relation_size(%s::regclass)", (name,)).fetchone()[0]
+    print(f"built {name} in {build_time:.1f}s, {size / 1024 / 1024:.1f} MiB")
+    # a fresh index is not in shared_buffers yet, prewarm it so the first ef is not measured cold
+    lib.prewarm(conn_string)
+    return name, build_time, size
+
+
+def measure_search(conn, queries, ef, ground_truth, k=10, warmup=10):
+    # single client latency and recall of every query at the given ef, on one pooled connection
+    for _, q_vector, tags in queries[:warmup]:
+        lib.vector_search_prepared(conn, q_vector, tags, k=k, ef=ef)
+
+    latencies = np.zeros(len(queries))
+    result_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    t_run = time()
+    for i, (_, q_vector, tags) in enumerate(queries):
+        t = time()
+        res = lib.vector_search_prepared(conn, q_vector, tags, k=k, ef=ef)
+        latencies[i] = (time() - t) * 1000
+        result_ids[i, : len(res)] = [row[0] for row in res]
+    wall_time = time() - t_run
+
+    query_ids = np.array([q[0] for q in queries])
+    recalls = lib.compute_recalls(ground_truth, query_ids, result_ids, k)
+    return latencies, recalls, len(queries) / wall_time
+
+
+def pareto_frontier(points, x="qps", y="mean_recall"):
+    # points that no other point beats on both throughput and recall, ordered by throughput
+    frontier = []
+    best_y = -np.inf
+    for point in sorted(points, key=lambda p: (-p[x], -p[y])):
+        if point[y] > best_y:
+            frontier.append(point)
+            best_y = point[y]
+    return frontier[::-1]
+
+
+def run_sweep(
+    conn_string,
+    ms=(8, 16, 32),
+    ef_constructions=(64, 128),
+    efs=(32, 64, 128, 256, 400),
+    limit=1000,
+    offset=0,
+    k=10,
+    output="sweep.json",
+    keep_indexes=False,
+    drop_other_indexes=False,
+):
+    # builds an index per (m, ef_construction), searches it at every ef and writes one machine readable
+    # report with per-query recall and latency, and the recall vs QPS pareto frontier of all configurations.
+    # other lantern_hnsw indexes on yfcc_passages could be picked by the planner instead of the one being
+    # measured. with drop_other_indexes they are dropped up front, and every build is checked with EXPLAIN
+    others = _hnsw_indexes(conn_string)
+    if others and drop_other_indexes:
+        for name in others:
+            _drop_index(conn_string, name)
+    elif others:
+        print(f"warning: other lantern_hnsw indexes exist on yfcc_passages: {others}")
+
+    ground_truth = lib.load_ground_truth(conn_string)
+    with lib.get_conn(conn_string) as conn:
+        queries = lib.fetch_queries(conn, range(offset, offset + limit))
+
+    configs = []
+    for m, ef_construction in product(ms, ef_constructions):
+        name, build_time, index_size = build_index(conn_string, m, ef_construction)
+        with lib.get_conn(conn_string) as conn:
+            check_index_used(conn, name, queries[0], k=k)
+            results = [(ef, *measure_search(conn, queries, ef, ground_truth, k=k)) for ef in efs]
+        for ef, latencies, recalls, qps in results:
+            config = {
+                "m": m,
+                "ef_construction": ef_construction,
+                "ef": ef,
+                "build_time_s": build_time,
+                "index_size_bytes": index_size,
+                "qps": qps,
+                "mean_recall": float(recalls.mean()),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+                "query_ids": [int(q[0]) for q in queries],
+                "latencies_ms": latencies.tolist(),
+                "recalls": recalls.tolist(),
+            }
+            print(f"m={m} ef_construction={ef_construction} ef={ef}: {qps:.1f} qps, recall {config['mean_recall']:.3f}, p99 {config['p99_ms']:.2f}ms")
+            configs.append(config)
+        if not keep_indexes:
+            _drop_index(conn_string, name)
+
+    summary_keys = ("m", "ef_construction", "ef", "qps", "mean_recall", "p99_ms", "index_size_bytes")
+    report = {
+        "k": k,
+        "queries": len(queries),
+        "configs": configs,
+        "pareto": [{key: c[key] for key in summary_keys} for c in pareto_frontier(configs)],
+    }
+    with open(output, "w") as f:
+        json.dump(report, f)
+    print(f"wrote {len(configs)} configurations to {output}")
+    return report